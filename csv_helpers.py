@@ -0,0 +1,86 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import csv
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+# The strings pandas' read_csv treats as missing by default
+NULL_VALUES = [
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'
+]
+
+def to_csv_table(df):
+    """Converts a dataframe to an Arrow table ready for pyarrow's CSV writer."""
+    # Keep booleans as True/False, matching what pandas' writer produced
+    bool_cols = [col for col in df.columns if pd.api.types.is_bool_dtype(df[col])]
+    if bool_cols:
+        df = df.assign(**{col: df[col].map({True: 'True', False: 'False'}) for col in bool_cols})
+    # Object columns can mix text and numbers (e.g. after concatenating files read with different types),
+    # which Arrow can't convert as one type, so they are written as text like pandas' writer did
+    object_cols = [col for col in df.columns if df[col].dtype == object]
+    if object_cols:
+        df = df.astype({col: pd.StringDtype("pyarrow") for col in object_cols})
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+def write_csv(df, sink):
+    """Writes a dataframe as CSV to a binary file-like object using pyarrow's multithreaded writer."""
+    pacsv.write_csv(to_csv_table(df), sink)
+
+def dedupe_column_names(names):
+    """Names blank headers 'Unnamed: <position>' and suffixes repeats with .1, .2, ... the way pandas does."""
+    names = [name or f"Unnamed: {i}" for i, name in enumerate(names)]
+    original_names = set(names)
+    counts = {}
+    deduped = []
+    for name in names:
+        base_name, count = name, counts.get(name, 0)
+        while count > 0:
+            counts[base_name] = count + 1
+            name = f"{base_name}.{count}"
+            # Skip suffixes that would clash with another header in the file
+            count = count + 1 if name in original_names else counts.get(name, 0)
+        counts[name] = count + 1
+        deduped.append(name)
+    return deduped
+
+def read_header_row(data, header_row=0, encoding='utf-8'):
+    """Returns the column names on the given non-blank row and the number of physical lines up to and including it."""
+    text = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig' if encoding == 'utf-8' else encoding, newline='')
+    reader = csv.reader(text)
+    # Blank lines are skipped when counting rows, matching the row numbers pandas shows in the preview
+    non_blank_rows = (row for row in reader if row)
+    for _ in range(header_row):
+        next(non_blank_rows, None)
+    headers = next(non_blank_rows, [])
+    return dedupe_column_names(headers), reader.line_num
+
+def read_csv_arrow(data, header_row=0, encoding='utf-8'):
+    """Parses CSV bytes with pyarrow's multithreaded reader into Arrow-backed text columns.
+
+    Raises pyarrow.ArrowInvalid on rows with a different number of fields than the header.
+    """
+    column_names, lines_to_skip = read_header_row(data, header_row, encoding)
+    read_options = pacsv.ReadOptions(column_names=column_names, skip_rows=lines_to_skip, encoding=encoding, block_size=8 << 20)
+    # Every column is read as text, so values pass through unchanged and phone numbers and zip codes keep their leading zeros
+    convert_options = pacsv.ConvertOptions(column_types={name: pa.string() for name in column_names}, null_values=NULL_VALUES, strings_can_be_null=True)
+    table = pacsv.read_csv(io.BytesIO(data), read_options=read_options, convert_options=convert_options)
+    # pandas' string dtype, unlike ArrowDtype, keeps groupby aggregations such as 'first' on its fast path
+    return table.to_pandas(types_mapper={pa.string(): pd.StringDtype("pyarrow")}.get)
+
+def read_uploaded_csv(file):
+    """Reads one uploaded CSV file into a dataframe."""
+    # IMPORTANT: Reset the file pointer to the beginning for each read
+    file.seek(0)
+    data = file.read()
+    try:
+        return read_csv_arrow(data)
+    except pa.ArrowInvalid:
+        # pyarrow rejects short rows; pandas' C reader pads them with blanks
+        return pd.read_csv(io.BytesIO(data), dtype=pd.StringDtype("pyarrow"))
+
+def read_uploaded_csvs(files):
+    """Reads several uploaded CSV files in parallel threads; the parser releases the GIL while it works."""
+    with ThreadPoolExecutor(max_workers=min(8, len(files))) as executor:
+        return list(executor.map(read_uploaded_csv, files))
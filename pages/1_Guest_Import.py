@@ -1,16 +1,27 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import functools
 import io
 import json
 import os
 import uuid
 import zipfile
+from csv_helpers import read_csv_arrow, to_csv_table, write_csv
 
 # --- ⚙️ App Configuration & State ---
 st.set_page_config(layout="wide", page_title="Guest Data Import")
 MAPPING_CONFIRMATION_THRESHOLD = 3
 FILE_ROW_LIMIT = 50000
 
+# Copy-on-Write lets each step below share the uploaded data instead of duplicating it.
+# It is always on from pandas 3.0, where the option is deprecated.
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
 # --- DATA & MAPPINGS ---
 MAPPINGS_FILE = 'mappings.json'
 COUNTRY_CODES = {
@@ -18,6 +29,8 @@ COUNTRY_CODES = {
     "United States": "1",
     "France": "33"
 }
+# Candidate formats for date columns, month-first before day-first to match pandas' default on ties
+DATE_FORMATS = ['%Y-%m-%d', '%m/%d/%Y', '%d/%m/%Y', '%d-%m-%Y']
 
 def load_mappings():
     """Loads mappings, ensuring the truthy values list exists and structure is correct."""
@@ -36,13 +49,40 @@ def load_mappings():
             json.dump(default_mappings, f, indent=2)
         return default_mappings
 
+def get_mappings_mtime():
+    """Returns the mappings file's modification time, which keys the cached lookups below."""
+    return os.path.getmtime(MAPPINGS_FILE) if os.path.exists(MAPPINGS_FILE) else None
+
+@st.cache_data(show_spinner=False)
+def load_mappings_cached(mappings_mtime):
+    """Loads mappings once per version of the file, keyed on its modification time."""
+    return load_mappings()
+
+@st.cache_resource(show_spinner=False)
+def get_reversed_map(mappings_mtime, threshold):
+    """Builds the lowercase lookup of confirmed column names once per version of the mappings file."""
+    # load_mappings() turns every entry except the truthy values list into a {variation: count} dict
+    return {
+        var.lower(): std
+        for std, var_dict in load_mappings_cached(mappings_mtime).items()
+        if std not in ('guestNotes', '_truthy_values_for_emailMarketingOk')
+        for var, count in var_dict.items()
+        if count >= threshold
+    }
+
 def save_mappings(mappings):
-    """Saves updated mappings back to the JSON file."""
-    with open(MAPPINGS_FILE, 'w', encoding='utf-8') as f:
+    """Saves updated mappings back to the JSON file, replacing it atomically."""
+    # A per-call temp name keeps concurrent sessions from writing into each other's temp file
+    tmp_file = f"{MAPPINGS_FILE}.tmp.{uuid.uuid4().hex}"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
         json.dump(mappings, f, indent=2)
+    os.replace(tmp_file, MAPPINGS_FILE)
+    load_mappings_cached.clear()
+    get_reversed_map.clear()
 
 # --- 📜 New Guest Schema and Rules ---
-RENAMING_MAP = load_mappings()
+RENAMING_MAP = load_mappings_cached(get_mappings_mtime())
+TRUTHY_SET = frozenset(str(v).lower() for v in RENAMING_MAP.get("_truthy_values_for_emailMarketingOk", []))
 STANDARD_COLUMNS = [
     'firstName', 'lastName', 'email', 'phoneNumber', 'mobileNumber', 'guestNotes',
     'emailMarketingOk', 'companyName', 'address1', 'address2', 'city', 'state',
@@ -51,37 +91,191 @@ STANDARD_COLUMNS = [
 MANUAL_MAPPING_OPTIONS = [col for col in STANDARD_COLUMNS if col != 'guestNotes']
 
 # --- ✨ Helper Functions ---
-def split_full_name(df, name_col):
-    if name_col not in df.columns: return
-    name_series = df[name_col].astype(str)
-    split_names = name_series.str.split(r'\s+', n=1, expand=True)
-    df['firstName_from_split'] = split_names[0]
-    df['lastName_from_split'] = split_names[1]
-    single_word_mask = df['lastName_from_split'].isnull() & df['firstName_from_split'].notnull()
-    df.loc[single_word_mask, 'lastName_from_split'] = df.loc[single_word_mask, 'firstName_from_split']
-    df.loc[single_word_mask, 'firstName_from_split'] = ''
-
-def format_phone_number(phone, hint_country_code=None):
-    """Intelligently formats a phone number string with a country code hint."""
-    if not isinstance(phone, str) or phone.strip() == '':
-        return phone
-    
-    cleaned_phone = "".join(filter(str.isdigit, phone))
-    
-    if phone.strip().startswith('+'):
-        return phone.strip()
-    
-    if hint_country_code and cleaned_phone.startswith(hint_country_code):
-        return f"+{cleaned_phone}"
-        
-    if cleaned_phone.startswith('44') and len(cleaned_phone) > 10:
-        return f"+{cleaned_phone}"
-    if cleaned_phone.startswith('1') and (len(cleaned_phone) == 11):
-        return f"+{cleaned_phone}"
-    if cleaned_phone.startswith('33') and len(cleaned_phone) > 9:
-        return f"+{cleaned_phone}"
-        
-    return phone
+@st.cache_data(show_spinner=False, max_entries=4)
+def read_guest_csv(file_bytes, header_row, encoding):
+    """Parses the uploaded file with Arrow-backed strings, once per file, header row and encoding."""
+    try:
+        return read_csv_arrow(file_bytes, header_row, encoding).fillna('')
+    except pa.ArrowInvalid:
+        # pyarrow rejects rows with fewer fields than the header; pandas' C reader pads them with blanks
+        return pd.read_csv(io.BytesIO(file_bytes), header=header_row, dtype=pd.StringDtype("pyarrow"), encoding=encoding).fillna('')
+
+def split_full_name(name_series):
+    """Splits a full name column into first and last names. Single names are treated as last names."""
+    # Uploads are already read as Arrow-backed strings, so only other columns need converting
+    if not pd.api.types.is_string_dtype(name_series):
+        name_series = name_series.astype('string[pyarrow]')
+    # Trim and collapse every run of whitespace to one space with Arrow's Unicode-aware kernels, so
+    # non-breaking spaces from Excel exports split like ordinary ones (RE2's \s only matches ASCII)
+    names = pa.array(name_series)
+    words = pc.utf8_split_whitespace(pc.utf8_trim_whitespace(names))
+    name_series = pd.Series(pc.binary_join(words, pa.scalar(' ', type=names.type)), index=name_series.index, dtype='string[pyarrow]')
+    parts = name_series.str.partition(' ')
+    first, separator, last = parts[0], parts[1], parts[2]
+    single_word_mask = separator.eq('').fillna(False).to_numpy()
+    first_names = pd.Series(np.where(single_word_mask, '', first), index=name_series.index, dtype='string[pyarrow]')
+    last_names = pd.Series(np.where(single_word_mask, first, last), index=name_series.index, dtype='string[pyarrow]')
+    return first_names, last_names
+
+def format_phone_series(phones, hint_country_code=None):
+    """Intelligently formats a column of phone number strings with a country code hint."""
+    stripped = phones.str.strip()
+    digits = stripped.str.replace(r'\D', '', regex=True)
+    has_plus = stripped.str.startswith('+', na=False)
+
+    needs_code = (
+        (digits.str.startswith('44', na=False) & (digits.str.len() > 10))
+        | (digits.str.startswith('1', na=False) & (digits.str.len() == 11))
+        | (digits.str.startswith('33', na=False) & (digits.str.len() > 9))
+    )
+    if hint_country_code:
+        needs_code |= digits.str.startswith(hint_country_code, na=False)
+    needs_code &= ~has_plus
+
+    # Numbers already starting with '+' are kept as typed; anything unrecognised is left untouched
+    return phones.mask(needs_code, '+' + digits).mask(has_plus, stripped)
+
+def normalize_marketing_values(values):
+    """Strips and lowercases marketing consent values so they can be matched against the truthy list."""
+    return values.astype('string[pyarrow]').str.strip().str.lower()
+
+def combine_notes(df, notes_cols):
+    """Joins the unique, non-blank values of the chosen columns into one notes string per row."""
+    stacked = df[notes_cols].astype('string[pyarrow]').stack().str.strip()
+    stacked = stacked[stacked.fillna('') != '']
+    joined = stacked.groupby(level=0, sort=False).agg(lambda values: ', '.join(dict.fromkeys(values)))
+    return joined.reindex(df.index, fill_value='')
+
+def format_mixed_dates(dates):
+    """Parses dates of any format as YYYY-MM-DD strings, leaving unparseable values missing."""
+    try:
+        return pd.to_datetime(dates, format='mixed', errors='coerce', cache=True).dt.strftime('%Y-%m-%d')
+    except ValueError:
+        # Naive and offset timestamps (or several offsets) can't share one column, so fall back to one value at a time
+        parsed = dates.map(lambda value: pd.to_datetime(value, errors='coerce'))
+        return parsed.map(lambda value: np.nan if pd.isna(value) else value.strftime('%Y-%m-%d'))
+
+def format_dates(dates):
+    """Parses a date column with the format that best fits a sample of it, and formats it as YYYY-MM-DD."""
+    has_value = dates.fillna('').str.strip() != ''
+    sample = dates[has_value].head(50)
+    best_format, best_count = None, 0
+    for date_format in DATE_FORMATS:
+        parsed_count = pd.to_datetime(sample, format=date_format, errors='coerce').notna().sum()
+        if parsed_count > best_count:
+            best_format, best_count = date_format, parsed_count
+    if best_format is None:
+        return format_mixed_dates(dates)
+
+    parsed = pd.to_datetime(dates, format=best_format, errors='coerce', cache=True)
+    formatted = parsed.dt.strftime('%Y-%m-%d')
+    # Values that don't match the sniffed format fall back to mixed parsing. Both parts are combined as
+    # strings, since the fallback may come back timezone-aware and can't be assigned into a naive column.
+    unparsed = parsed.isna() & has_value
+    if unparsed.any():
+        formatted[unparsed] = format_mixed_dates(dates[unparsed])
+    return formatted
+
+def generate_guest_ids(count):
+    """Generates random 32-character hex IDs from a single batch of random bytes."""
+    raw_hex = os.urandom(16 * count).hex()
+    return [raw_hex[i:i + 32] for i in range(0, len(raw_hex), 32)]
+
+@st.cache_data(show_spinner="Processing...", max_entries=4)
+def process_guest_data(mapped_df, manual_rename_dict, notes_cols_to_combine, truthy_values, treat_all_non_blank_as_true, hint_code):
+    """Cleans, validates and deduplicates the mapped guest data, returning the final frame and row counts.
+
+    Pure with respect to its arguments, so repeated runs with the same data and settings are served from cache
+    (including the generated originalGuestId values).
+    """
+    processed_df = mapped_df.rename(columns=manual_rename_dict)
+    if 'emailMarketingOk' in processed_df.columns:
+        # Only the few distinct values are normalised and tested; rows pick up the result through their category code
+        marketing = processed_df['emailMarketingOk'].astype('category')
+        category_values = normalize_marketing_values(marketing.cat.categories.to_series())
+        if treat_all_non_blank_as_true:
+            category_ok = category_values.ne('').to_numpy(dtype=bool)
+        else:
+            category_ok = category_values.isin(truthy_values).to_numpy(dtype=bool)
+        # Missing values have code -1, which picks the appended False
+        marketing_ok = np.append(category_ok, False)[marketing.cat.codes.to_numpy()]
+        processed_df['emailMarketingOk'] = pd.Series(marketing_ok, index=processed_df.index, dtype='boolean')
+    if notes_cols_to_combine:
+        processed_df['guestNotes'] = combine_notes(processed_df, notes_cols_to_combine)
+    for date_col in ['dateOfBirth', 'dateOfAnniversary']:
+        if date_col in processed_df.columns:
+            processed_df[date_col] = format_dates(processed_df[date_col])
+    for name_col in ['firstName', 'lastName']:
+        if name_col in processed_df.columns:
+             # On Arrow-backed strings pandas runs this as pyarrow's utf8_title kernel instead of per-value str.title
+             processed_df[name_col] = processed_df[name_col].astype('string[pyarrow]').str.title()
+
+    for phone_col in ['phoneNumber', 'mobileNumber']:
+        if phone_col in processed_df.columns:
+            processed_df[phone_col] = format_phone_series(processed_df[phone_col], hint_code)
+
+    # --- VALIDATION & DELETION ---
+    # Build one keep mask for all the rules and slice the frame once at the end
+    if 'lastName' in processed_df.columns:
+        valid_mask = processed_df['lastName'].fillna('').str.strip().to_numpy() != ''
+    else:
+        valid_mask = np.zeros(len(processed_df), dtype=bool)
+    contact_cols = [col for col in ['email', 'phoneNumber', 'mobileNumber'] if col in processed_df.columns]
+    for col in contact_cols:
+        # Stripped once here and reused by the deduplication step below
+        processed_df[col] = processed_df[col].fillna('').str.strip()
+    if contact_cols:
+        valid_mask &= ~(processed_df[contact_cols].to_numpy() == '').all(axis=1)
+    stats = {'rows_deleted': int((~valid_mask).sum()), 'ids_deleted': 0, 'ids_created': False, 'rows_merged': 0}
+
+    # --- originalGuestId LOGIC ---
+    if 'originalGuestId' in processed_df.columns:
+        keep_mask = valid_mask & (processed_df['originalGuestId'].fillna('').str.strip() != '')
+        keep_mask &= ~processed_df['originalGuestId'].where(keep_mask).duplicated(keep='first')
+        processed_df = processed_df.loc[keep_mask]
+        stats['ids_deleted'] = int(valid_mask.sum() - keep_mask.sum())
+    else:
+        processed_df = processed_df.loc[valid_mask]
+        processed_df['originalGuestId'] = generate_guest_ids(len(processed_df))
+        stats['ids_created'] = True
+
+    # --- DEDUPLICATION LOGIC ---
+    initial_rows_dedup = len(processed_df)
+    dedup_cols = [col for col in ['email', 'phoneNumber', 'mobileNumber'] if col in processed_df.columns]
+    for col in dedup_cols:
+        processed_df[col] = processed_df[col].replace('', pd.NA)
+
+    # The key is the first available contact detail, in order of preference. Coalescing column by column
+    # avoids the transpose a horizontal bfill does on Arrow-backed strings.
+    if dedup_cols:
+        processed_df['dedup_key'] = functools.reduce(lambda key, contact: key.fillna(contact), (processed_df[col] for col in dedup_cols))
+    else:
+        processed_df['dedup_key'] = pd.Series(pd.NA, index=processed_df.index, dtype='string[pyarrow]')
+
+    if 'guestNotes' in processed_df.columns:
+        processed_df['guestNotes'] = processed_df['guestNotes'].astype('string[pyarrow]').replace('', pd.NA)
+
+    dedup_keys = ['firstName', 'lastName', 'dedup_key']
+    agg_rules = {}
+    for col in processed_df.columns:
+        if col not in dedup_keys + ['guestNotes']:
+            if col == 'emailMarketingOk': agg_rules[col] = 'max'
+            else: agg_rules[col] = 'first'
+
+    if all(col in processed_df.columns for col in dedup_keys):
+        # Categorical keys let the groupby hash small integer codes instead of strings
+        processed_df = processed_df.astype({col: 'category' for col in dedup_keys})
+        deduplicated_df = processed_df.groupby(dedup_keys, observed=True).agg(agg_rules)
+        if 'guestNotes' in processed_df.columns:
+            # Notes use the built-in unique aggregation on rows that have notes, then one join per group
+            notes = processed_df.dropna(subset=['guestNotes']).groupby(dedup_keys, observed=True)['guestNotes'].unique()
+            deduplicated_df['guestNotes'] = notes.str.join(', ').reindex(deduplicated_df.index, fill_value='')
+        deduplicated_df = deduplicated_df.reset_index().drop(columns=['dedup_key'])
+        stats['rows_merged'] = initial_rows_dedup - len(deduplicated_df)
+        processed_df = deduplicated_df
+
+    final_cols = pd.Index(STANDARD_COLUMNS).intersection(processed_df.columns, sort=False)
+    return processed_df[final_cols], stats
 
 # --- 🎨 App UI ---
 st.title("👤 Guest Data Import Tool")
@@ -109,12 +303,12 @@ if uploaded_file:
     if 'preview_df' not in st.session_state:
         try:
             uploaded_file.seek(0)
-            st.session_state.preview_df = pd.read_csv(uploaded_file, header=None, nrows=8, dtype=str, encoding='utf-8').fillna('')
+            st.session_state.preview_df = pd.read_csv(uploaded_file, header=None, nrows=8, dtype=str, encoding='utf-8', dtype_backend='pyarrow').fillna('')
             st.session_state.encoding = 'utf-8'
         except UnicodeDecodeError:
             st.warning("⚠️ Could not read the file with standard encoding. Trying a more flexible one.")
             uploaded_file.seek(0)
-            st.session_state.preview_df = pd.read_csv(uploaded_file, header=None, nrows=8, dtype=str, encoding='latin-1').fillna('')
+            st.session_state.preview_df = pd.read_csv(uploaded_file, header=None, nrows=8, dtype=str, encoding='latin-1', dtype_backend='pyarrow').fillna('')
             st.session_state.encoding = 'latin-1'
 
     options = []
@@ -127,8 +321,7 @@ if uploaded_file:
 
     if st.button("Confirm Setup and Continue"):
         header_row_number = st.session_state.header_row_index + 1
-        uploaded_file.seek(0)
-        df = pd.read_csv(uploaded_file, header=header_row_number - 1, dtype=str, encoding=st.session_state.encoding).fillna('')
+        df = read_guest_csv(uploaded_file.getvalue(), header_row_number - 1, st.session_state.encoding)
         
         # --- NEW: Remove empty columns ---
         original_cols = df.columns.tolist()
@@ -148,55 +341,55 @@ if st.session_state.get('header_confirmed'):
     st.dataframe(st.session_state.original_df.head(50))
     
     st.subheader("Step 2: Handle 'Full Name' (Optional)")
-    df_step1 = st.session_state.original_df.copy()
+    df_step1 = st.session_state.original_df
     with st.expander("Expand if your file has a combined 'Full Name' column"):
         name_col_to_split = st.selectbox("Select the column containing the full name", options=["-- None --"] + df_step1.columns.tolist())
         if name_col_to_split != "-- None --":
-            split_full_name(df_step1, name_col_to_split)
-            if 'firstName' not in df_step1.columns: df_step1['firstName'] = ''
-            if 'lastName' not in df_step1.columns: df_step1['lastName'] = ''
-            df_step1['firstName'] = df_step1['firstName'].replace('', pd.NA).fillna(df_step1.get('firstName_from_split'))
-            df_step1['lastName'] = df_step1['lastName'].replace('', pd.NA).fillna(df_step1.get('lastName_from_split'))
+            # Only the two name columns change, so the rest of the frame is shared rather than copied
+            split_cols = dict(zip(['firstName', 'lastName'], split_full_name(df_step1[name_col_to_split])))
+            for col, split_values in split_cols.items():
+                if col in df_step1.columns:
+                    # Existing names win; blanks take the split value in a single vectorised pick
+                    existing = df_step1[col].fillna('').to_numpy()
+                    split_cols[col] = pd.Series(np.where(existing == '', split_values.to_numpy(), existing), index=df_step1.index, dtype='string[pyarrow]')
+            df_step1 = df_step1.assign(**split_cols)
             st.info("✅ 'Full Name' has been split.")
     st.session_state.df_after_split = df_step1
 
     st.subheader("Step 3: Map Your Columns")
-    df_step2 = st.session_state.df_after_split.copy()
+    df_step2 = st.session_state.df_after_split
     st.session_state.manual_mappings = st.session_state.get('manual_mappings', {})
     
-    reversed_map = {}
-    for std, var_dict in RENAMING_MAP.items():
-        if std != 'guestNotes' and isinstance(var_dict, dict):
-            for var, count in var_dict.items():
-                if count >= MAPPING_CONFIRMATION_THRESHOLD:
-                    reversed_map[var.lower()] = std
+    reversed_map = get_reversed_map(get_mappings_mtime(), MAPPING_CONFIRMATION_THRESHOLD)
     
-    auto_rename_dict = {col: reversed_map[col.lower()] for col in df_step2.columns if col.lower() in reversed_map}
+    mapped_names = df_step2.columns.str.lower().map(reversed_map)
+    auto_rename_dict = dict(zip(df_step2.columns[mapped_names.notna()], mapped_names.dropna()))
     
     st.info(f"✅ Automatically mapped **{len(auto_rename_dict)}** columns based on confirmed rules.")
     if auto_rename_dict:
         with st.expander("Click here to see the automatically mapped columns"):
             st.table(pd.DataFrame(list(auto_rename_dict.items()), columns=['Your Column', 'Mapped To']))
     
-    df_step2.rename(columns=auto_rename_dict, inplace=True)
+    df_step2 = df_step2.set_axis(df_step2.columns.where(mapped_names.isna(), mapped_names), axis=1)
     
     unmapped_columns = [col for col in df_step2.columns if col not in STANDARD_COLUMNS]
     if unmapped_columns:
         st.warning(f"Map any remaining columns. Unmapped columns will be available for 'Guest Notes' in the next step.")
         cols = st.columns(3)
+        options = ["-- Leave Unmapped --"] + MANUAL_MAPPING_OPTIONS
         for i, col_name in enumerate(unmapped_columns):
             with cols[i % 3]:
-                options = ["-- Leave Unmapped --"] + MANUAL_MAPPING_OPTIONS
                 st.session_state.manual_mappings[col_name] = st.selectbox(f"Map '**{col_name}**'", options, key=f"map_{col_name}")
     
     st.session_state.df_after_mapping_display = df_step2
 
     st.subheader("Step 4: Clarify Marketing Consent (Optional)")
-    df_step3 = st.session_state.df_after_mapping_display.copy()
+    df_step3 = st.session_state.df_after_mapping_display
     if 'emailMarketingOk' in df_step3.columns:
-        truthy_values = [str(v).lower() for v in RENAMING_MAP.get("_truthy_values_for_emailMarketingOk", [])]
-        unique_values = df_step3['emailMarketingOk'].str.lower().str.strip().replace('', pd.NA).dropna().unique()
-        unknown_values = [v for v in unique_values if v not in truthy_values]
+        # One Arrow pass lowercases and trims; blanks and nulls are dropped from the few unique values afterwards
+        marketing_array = pa.array(df_step3['emailMarketingOk'].astype('string[pyarrow]'))
+        unique_values = pc.unique(pc.utf8_trim_whitespace(pc.utf8_lower(marketing_array))).to_pylist()
+        unknown_values = [v for v in unique_values if v and v not in TRUTHY_SET]
         
         if unknown_values:
             with st.expander("Expand to teach the app new marketing consent values", expanded=True):
@@ -208,109 +401,47 @@ if st.session_state.get('header_confirmed'):
     st.subheader("Step 5: Combine Notes & Finalize")
     potential_notes_cols = [col for col in st.session_state.df_after_mapping_display.columns if col not in STANDARD_COLUMNS]
     notes_cols_to_combine = st.multiselect("Select columns to combine into 'guestNotes'", options=potential_notes_cols)
+    fast_zip_download = st.checkbox(f"Fast download for files over {FILE_ROW_LIMIT} rows (larger ZIP, no compression)")
 
     if st.button("🚀 Process, Clean, and Validate"):
-        processed_df = st.session_state.df_after_mapping_display.copy()
         manual_rename_dict_final = {orig: new for orig, new in st.session_state.manual_mappings.items() if new != "-- Leave Unmapped --"}
-        processed_df.rename(columns=manual_rename_dict_final, inplace=True)
         
         # --- LEARNING & FORMATTING ---
+        # Learned values are collected in memory and written to disk once, at the end
+        mappings_changed = False
+        truthy_values = TRUTHY_SET
         if 'new_truthy_values' in st.session_state and st.session_state.new_truthy_values:
             RENAMING_MAP["_truthy_values_for_emailMarketingOk"].extend(st.session_state.new_truthy_values)
-            save_mappings(RENAMING_MAP)
+            truthy_values = truthy_values.union(str(v).lower() for v in st.session_state.new_truthy_values)
+            mappings_changed = True
             st.toast("🧠 New marketing consent values learned!")
-        final_truthy_values = [str(v).lower() for v in RENAMING_MAP.get("_truthy_values_for_emailMarketingOk", [])]
-        if 'emailMarketingOk' in processed_df.columns:
-            if st.session_state.get('treat_all_non_blank_as_true', False):
-                processed_df['emailMarketingOk'] = processed_df['emailMarketingOk'].str.strip().ne('')
-            else:
-                processed_df['emailMarketingOk'] = processed_df['emailMarketingOk'].str.lower().isin(final_truthy_values)
-        if notes_cols_to_combine:
-            processed_df['guestNotes'] = processed_df[notes_cols_to_combine].apply(lambda x: ', '.join(x.dropna().astype(str).str.strip().replace('', None).dropna().unique()), axis=1)
-        for date_col in ['dateOfBirth', 'dateOfAnniversary']:
-            if date_col in processed_df.columns:
-                processed_df[date_col] = pd.to_datetime(processed_df[date_col], errors='coerce').dt.strftime('%Y-%m-%d')
-        for name_col in ['firstName', 'lastName']:
-            if name_col in processed_df.columns:
-                 processed_df[name_col] = processed_df[name_col].str.title()
-        
+        final_truthy_values = tuple(sorted(truthy_values))
         hint_code = COUNTRY_CODES.get(st.session_state.get('country_hint'))
-        for phone_col in ['phoneNumber', 'mobileNumber']:
-            if phone_col in processed_df.columns:
-                processed_df[phone_col] = processed_df[phone_col].apply(format_phone_number, args=(hint_code,))
-        
-        # --- VALIDATION & DELETION ---
-        initial_rows = len(processed_df)
-        if 'lastName' in processed_df.columns:
-            processed_df = processed_df[processed_df['lastName'].str.strip() != '']
-        else:
-            processed_df = processed_df.iloc[0:0]
-        contact_cols = [col for col in ['email', 'phoneNumber', 'mobileNumber'] if col in processed_df.columns]
-        if contact_cols:
-            all_contacts_blank_mask = processed_df[contact_cols].apply(lambda x: x.str.strip().eq('')).all(axis=1)
-            processed_df = processed_df[~all_contacts_blank_mask]
-        rows_deleted = initial_rows - len(processed_df)
-        st.success(f"✅ Initial validation complete! **{rows_deleted}** invalid rows were deleted.")
-
-        # --- originalGuestId LOGIC ---
-        if 'originalGuestId' in processed_df.columns:
-            initial_id_rows = len(processed_df)
-            processed_df.dropna(subset=['originalGuestId'], inplace=True)
-            processed_df = processed_df[processed_df['originalGuestId'].str.strip() != '']
-            processed_df.drop_duplicates(subset=['originalGuestId'], keep='first', inplace=True)
-            ids_deleted = initial_id_rows - len(processed_df)
-            if ids_deleted > 0:
-                st.warning(f"🚨 Deleted **{ids_deleted}** rows with blank or duplicate 'originalGuestId' values.")
-        else:
-            processed_df['originalGuestId'] = [uuid.uuid4().hex for _ in range(len(processed_df))]
+        final_df, stats = process_guest_data(
+            st.session_state.df_after_mapping_display, manual_rename_dict_final, notes_cols_to_combine, final_truthy_values,
+            st.session_state.get('treat_all_non_blank_as_true', False), hint_code
+        )
+        st.success(f"✅ Initial validation complete! **{stats['rows_deleted']}** invalid rows were deleted.")
+        if stats['ids_deleted'] > 0:
+            st.warning(f"🚨 Deleted **{stats['ids_deleted']}** rows with blank or duplicate 'originalGuestId' values.")
+        if stats['ids_created']:
             st.info("✅ Created a new 'originalGuestId' column.")
-
-        # --- DEDUPLICATION LOGIC ---
-        initial_rows_dedup = len(processed_df)
-        for col in ['email', 'phoneNumber', 'mobileNumber']:
-            if col in processed_df.columns:
-                processed_df[col] = processed_df[col].str.strip().replace('', pd.NA)
-        
-        dedup_key_series = pd.Series(pd.NA, index=processed_df.index, dtype=str)
-        if 'email' in processed_df.columns:
-            dedup_key_series = dedup_key_series.fillna(processed_df['email'])
-        if 'phoneNumber' in processed_df.columns:
-            dedup_key_series = dedup_key_series.fillna(processed_df['phoneNumber'])
-        if 'mobileNumber' in processed_df.columns:
-            dedup_key_series = dedup_key_series.fillna(processed_df['mobileNumber'])
-        processed_df['dedup_key'] = dedup_key_series
-        
-        agg_rules = {}
-        for col in processed_df.columns:
-            if col not in ['firstName', 'lastName', 'dedup_key']:
-                if col == 'emailMarketingOk': agg_rules[col] = 'max'
-                elif col == 'guestNotes': agg_rules[col] = lambda x: ', '.join(x.dropna().astype(str).unique())
-                else: agg_rules[col] = 'first'
-        
-        if 'firstName' in processed_df.columns and 'lastName' in processed_df.columns and 'dedup_key' in processed_df.columns:
-            deduplicated_df = processed_df.groupby(['firstName', 'lastName', 'dedup_key'], as_index=False).agg(agg_rules)
-            deduplicated_df.drop(columns=['dedup_key'], inplace=True, errors='ignore')
-            rows_merged = initial_rows_dedup - len(deduplicated_df)
-            if rows_merged > 0:
-                st.info(f"✨ Merged **{rows_merged}** duplicate rows.")
-            processed_df = deduplicated_df
+        if stats['rows_merged'] > 0:
+            st.info(f"✨ Merged **{stats['rows_merged']}** duplicate rows.")
 
         # --- LEARNING COLUMN MAPPINGS ---
-        manual_rename_dict_final = {orig: new for orig, new in st.session_state.manual_mappings.items() if new != "-- Leave Unmapped --"}
-        new_mappings_learned = False
         for original_name, standard_name in manual_rename_dict_final.items():
             if standard_name not in RENAMING_MAP or not isinstance(RENAMING_MAP[standard_name], dict):
                 RENAMING_MAP[standard_name] = {}
             current_count = RENAMING_MAP[standard_name].get(original_name, 0)
             RENAMING_MAP[standard_name][original_name] = current_count + 1
-            new_mappings_learned = True
-        if new_mappings_learned:
-            save_mappings(RENAMING_MAP)
+        if manual_rename_dict_final:
+            mappings_changed = True
             st.toast("🧠 Mapping suggestions have been updated!")
+        if mappings_changed:
+            save_mappings(RENAMING_MAP)
             
         # --- FINAL DOWNLOAD ---
-        final_cols = [col for col in STANDARD_COLUMNS if col in processed_df.columns]
-        final_df = processed_df[final_cols]
         st.subheader("Final Processed Data")
         st.dataframe(final_df.head())
         
@@ -321,15 +452,20 @@ if st.session_state.get('header_confirmed'):
             if len(final_df) > FILE_ROW_LIMIT:
                 st.warning(f"Data has {len(final_df)} rows. It will be split into multiple files.")
                 zip_buffer = io.BytesIO()
-                with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-                    num_chunks = (len(final_df) // FILE_ROW_LIMIT) + 1
-                    for i in range(num_chunks):
-                        chunk = final_df.iloc[i*FILE_ROW_LIMIT:(i+1)*FILE_ROW_LIMIT]
+                # Level 1 compresses much faster than the default level 6 for only a slightly larger file
+                zip_compression = zipfile.ZIP_STORED if fast_zip_download else zipfile.ZIP_DEFLATED
+                with zipfile.ZipFile(zip_buffer, 'w', zip_compression, compresslevel=1) as zf:
+                    # Ceiling division, so an exact multiple of the limit doesn't add an empty trailing file
+                    num_chunks = -(-len(final_df) // FILE_ROW_LIMIT)
+                    # Converted once; each chunk is a zero-copy slice of the Arrow table
+                    final_table = to_csv_table(final_df)
+                    for i, start in enumerate(range(0, len(final_df), FILE_ROW_LIMIT)):
                         chunk_filename = f"{rid}_CLEANED_{i+1}.csv"
-                        zf.writestr(chunk_filename, chunk.to_csv(index=False))
+                        with zf.open(chunk_filename, 'w') as chunk_file:
+                            pacsv.write_csv(final_table.slice(start, FILE_ROW_LIMIT), chunk_file)
                 st.download_button(label=f"⬇️ Download All Files ({num_chunks}) as ZIP", data=zip_buffer.getvalue(), file_name=f"{rid}_CLEANED_FILES.zip", mime="application/zip")
             else:
-                csv_buffer = io.StringIO()
-                final_df.to_csv(csv_buffer, index=False)
+                csv_buffer = io.BytesIO()
+                write_csv(final_df, csv_buffer)
                 new_filename = f"{rid}_CLEANED.csv"
                 st.download_button(label="⬇️ Download Cleaned Guest Data", data=csv_buffer.getvalue(), file_name=new_filename, mime="text/csv")
\ No newline at end of file
@@ -1,6 +1,44 @@
 import streamlit as st
 import pandas as pd
+import codecs
+import csv
 import io
+from csv_helpers import read_uploaded_csvs, write_csv
+
+# --- ✨ Helper Functions ---
+def parse_header(first_line):
+    """Parses a CSV header line into its column names, ignoring a UTF-8 BOM, quoting and the line ending."""
+    return next(csv.reader([first_line.removeprefix(codecs.BOM_UTF8).decode('utf-8', errors='replace')]), [])
+
+def count_csv_rows(body):
+    """Counts the non-blank CSV records in a file body, so quoted newlines don't count as extra rows."""
+    return sum(1 for row in csv.reader(io.StringIO(body.decode('utf-8', errors='replace'), newline='')) if row)
+
+def append_csv_bytes(files):
+    """Stacks CSV files as raw bytes, keeping only the first file's header line.
+
+    Returns None if any file's columns differ from the first file's, so the caller can align them by name instead.
+    """
+    out = io.BytesIO()
+    header = None
+    data_rows = 0
+    for file in files:
+        # IMPORTANT: Reset the file pointer to the beginning for each read
+        file.seek(0)
+        first_line = file.readline()
+        file_header = parse_header(first_line)
+        if header is None:
+            header = file_header
+            out.write(first_line if first_line.endswith(b'\n') else first_line + b'\n')
+        elif file_header != header:
+            return None
+
+        body = file.read()
+        if body and not body.endswith(b'\n'):
+            body += b'\n'
+        out.write(body)
+        data_rows += count_csv_rows(body)
+    return out.getvalue(), data_rows
 
 # --- 🎨 App UI ---
 st.title("Append Multiple CSVs ➕")
@@ -22,36 +60,39 @@ uploaded_files = st.file_uploader(
 if st.button("Append Files", disabled=(not uploaded_files)):
     if uploaded_files:
         try:
-            # Create a list to hold all the individual DataFrames
-            df_list = []
-            
-            # Read each uploaded file into a DataFrame and add it to the list
-            for file in uploaded_files:
-                # IMPORTANT: Reset the file pointer to the beginning for each read
-                file.seek(0)
-                df_list.append(pd.read_csv(file))
-
-            # Concatenate all DataFrames in the list into a single one
-            combined_df = pd.concat(df_list, ignore_index=True)
-            
+            # Files with identical headers are copied byte-for-byte without parsing them
+            appended = append_csv_bytes(uploaded_files)
+            if appended is not None:
+                csv_data, total_rows = appended
+                preview_df = pd.read_csv(io.BytesIO(csv_data), nrows=5, dtype=str)
+            else:
+                # Headers differ (e.g. reordered columns), so read each file and line the columns up by name
+                df_list = read_uploaded_csvs(uploaded_files)
+
+                # Concatenate all DataFrames in the list into a single one
+                combined_df = pd.concat(df_list, ignore_index=True)
+                preview_df = combined_df.head()
+                total_rows = len(combined_df)
+
+                csv_buffer = io.BytesIO()
+                write_csv(combined_df, csv_buffer)
+                csv_data = csv_buffer.getvalue()
+
             st.success("Files appended successfully!")
-            
+
             # Show a preview of the combined data
             st.subheader("Combined Data Preview")
-            st.dataframe(combined_df.head())
-            st.info(f"Total rows in combined file: **{len(combined_df)}**")
+            st.dataframe(preview_df)
+            st.info(f"Total rows in combined file: **{total_rows}**")
 
             # --- 3. Download Button ---
-            csv_buffer = io.StringIO()
-            combined_df.to_csv(csv_buffer, index=False)
-            
             st.download_button(
                 label="⬇️ Download Combined CSV",
-                data=csv_buffer.getvalue(),
+                data=csv_data,
                 file_name="appended_data.csv",
                 mime="text/csv"
             )
-            
+
         except Exception as e:
             st.error(f"An error occurred: {e}. Please ensure all files have identical headers.")
     else:
@@ -1,7 +1,10 @@
 import streamlit as st
 import pandas as pd
+import csv
 import io
 import json
+import os
+from csv_helpers import read_uploaded_csvs, write_csv
 
 # --- 🧠 File-Based "Memory" for Mappings ---
 MAPPINGS_FILE = 'mappings.json'
@@ -26,18 +29,36 @@ def load_mappings():
         return default_mappings
 
 # --- ✨ Helper Functions ---
-def standardize_headers(df, mappings):
-    """Standardizes the headers of a dataframe based on the mapping rules."""
-    # Create a reverse map for quick lookup, converting all variations to lowercase
-    reversed_map = {var.lower(): std for std, var_list in mappings.items() for var in var_list}
-    
-    rename_dict = {}
-    for col in df.columns:
-        if col.lower() in reversed_map:
-            rename_dict[col] = reversed_map[col.lower()]
-            
+def build_reversed_map(mappings):
+    """Creates a reverse map for quick lookup, converting all variations to lowercase."""
+    return {var.lower(): std for std, var_list in mappings.items() for var in var_list}
+
+@st.cache_data(show_spinner=False)
+def load_reversed_map(mappings_mtime):
+    """Loads the header lookup, cached until the mappings file's modification time changes."""
+    return build_reversed_map(load_mappings())
+
+def standardize_headers(df, reversed_map):
+    """Standardizes the headers of a dataframe based on the reversed mapping rules."""
+    lowered = df.columns.str.lower()
+    rename_dict = {col: reversed_map[low] for col, low in zip(df.columns, lowered) if low in reversed_map}
     return df.rename(columns=rename_dict)
 
+def read_header(file):
+    """Reads just the first line of a CSV file and returns its column names."""
+    file.seek(0)
+    first_line = file.readline().decode('utf-8-sig', errors='replace')
+    return next(csv.reader([first_line]), [])
+
+def standardize_header_names(headers, reversed_map):
+    """Standardizes a list of header names based on the reversed mapping rules."""
+    return [reversed_map.get(header.lower(), header) for header in headers]
+
+def merge_notes(df, id_column, notes_column):
+    """Joins the unique notes recorded for each ID with a pipe separator."""
+    notes = df[[id_column, notes_column]].dropna().astype({notes_column: str}).drop_duplicates()
+    return notes.groupby(id_column, sort=False)[notes_column].agg(' | '.join)
+
 # --- 🎨 App UI ---
 st.title("Merge Multiple CSVs by ID 🔗")
 st.write(
@@ -55,17 +76,15 @@ uploaded_files = st.file_uploader(
 )
 
 # --- 2. Find Common Columns (after potential standardization) ---
+reversed_map = load_reversed_map(os.path.getmtime(MAPPINGS_FILE) if os.path.exists(MAPPINGS_FILE) else None)
 common_columns = []
 if len(uploaded_files) > 1:
     try:
-        mappings = load_mappings()
         all_column_sets = []
         for f in uploaded_files:
-            f.seek(0)
-            # Read only the first row to get headers, which is faster
-            temp_df = pd.read_csv(f, nrows=0)
-            standardized_df = standardize_headers(temp_df, mappings)
-            all_column_sets.append(set(standardized_df.columns))
+            # Read only the header line, which is much faster than parsing the file
+            headers = read_header(f)
+            all_column_sets.append(set(standardize_header_names(headers, reversed_map)))
         
         if all_column_sets:
             common_columns_set = set.intersection(*all_column_sets)
@@ -85,45 +104,21 @@ id_column = st.selectbox(
 # --- 3. Processing Logic ---
 if st.button("Merge Files", disabled=(not id_column)):
     try:
-        mappings = load_mappings()
-        
         # Step 1: Standardize all dataframes and store them
-        standardized_dfs = []
-        for file in uploaded_files:
-            file.seek(0)
-            df = pd.read_csv(file)
-            standardized_df = standardize_headers(df, mappings)
-            standardized_dfs.append(standardized_df)
-
-        # Step 2: Get a master list of all unique IDs and all unique columns
-        all_ids = pd.concat([df[id_column] for df in standardized_dfs if id_column in df.columns]).dropna().unique()
-        all_cols = set(col for df in standardized_dfs for col in df.columns)
-        
-        # Step 3: Build the final dataframe piece by piece
-        final_df = pd.DataFrame({id_column: all_ids})
-
-        for col_name in sorted(list(all_cols)):
-            if col_name == id_column:
-                continue
-
-            # Start with an empty series for this column
-            final_series = pd.Series(index=final_df[id_column], dtype='object', name=col_name)
-
-            # Go through each dataframe and fill in the data for the current column
-            for df in standardized_dfs:
-                if col_name in df.columns:
-                    # Create a temporary series with the ID as the index
-                    temp_series = df.set_index(id_column)[col_name].dropna()
-                    
-                    # For notes, append new info. For others, fill in blanks.
-                    if any(keyword in col_name.lower() for keyword in ['notes', 'tags', 'dietary']):
-                        final_series = final_series.combine(temp_series, 
-                            lambda s1, s2: f"{s1} | {s2}" if pd.notna(s1) and pd.notna(s2) else s1 if pd.notna(s1) else s2
-                        )
-                    else:
-                        final_series.fillna(temp_series, inplace=True)
-            
-            final_df[col_name] = final_series.values
+        standardized_dfs = [standardize_headers(df, reversed_map) for df in read_uploaded_csvs(uploaded_files)]
+
+        # Step 2: Stack every file into one frame; every column is read as text, so ID types already match
+        combined_df = pd.concat(standardized_dfs, ignore_index=True)
+
+        # Step 3: Collapse rows per ID. For notes, append new info. For others, keep the first value found.
+        all_cols = sorted(col for col in combined_df.columns if col != id_column)
+        notes_cols = [col for col in all_cols if any(keyword in col.lower() for keyword in ['notes', 'tags', 'dietary'])]
+        other_cols = [col for col in all_cols if col not in notes_cols]
+
+        final_df = combined_df.groupby(id_column, sort=False, as_index=False)[other_cols].first()
+        for col_name in notes_cols:
+            final_df[col_name] = final_df[id_column].map(merge_notes(combined_df, id_column, col_name))
+        final_df = final_df[[id_column] + all_cols]
 
         st.success("Files merged and cleaned successfully!")
 
@@ -131,8 +126,8 @@ if st.button("Merge Files", disabled=(not id_column)):
         st.dataframe(final_df.head())
         st.info(f"Total rows in final file: **{len(final_df)}**. Total columns: **{len(final_df.columns)}**.")
 
-        csv_buffer = io.StringIO()
-        final_df.to_csv(csv_buffer, index=False)
+        csv_buffer = io.BytesIO()
+        write_csv(final_df, csv_buffer)
         
         st.download_button(
             label="⬇️ Download Cleaned CSV",